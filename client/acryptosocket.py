@@ -1,23 +1,61 @@
 import os
 import hashlib
+import hmac
+import struct
 import asyncio
-from Crypto.Cipher import AES
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 
-def hash(*args):
-    h = hashlib.sha256()
-    for arg in args:
-        h.update(arg)
-    return h.digest()[0:16]
+    def aes_key(key):
+        return algorithms.AES(key)
+
+    def aes_ecb_encryptor(key):
+        return Cipher(key, modes.ECB()).encryptor().update
+
+    def aes_cbc_decrypt_into(key, iv, data, out):
+        aes = Cipher(key, modes.CBC(iv)).decryptor()
+        aes.update_into(data, out)
+
+    def aes_cbc_encrypt_into(key, iv, data, out):
+        # OpenSSL wants one block minus one byte of slack after the output
+        aes = Cipher(key, modes.CBC(iv)).encryptor()
+        aes.update_into(data, out)
+except ImportError:
+    from Crypto.Cipher import AES
+
+    def aes_key(key):
+        return key
+
+    def aes_ecb_encryptor(key):
+        return AES.new(key, AES.MODE_ECB).encrypt
+
+    def aes_cbc_decrypt_into(key, iv, data, out):
+        AES.new(key, AES.MODE_CBC, iv).decrypt(data, output=out[:len(data)])
+
+    def aes_cbc_encrypt_into(key, iv, data, out):
+        AES.new(key, AES.MODE_CBC, iv).encrypt(data, output=out[:len(data)])
+
+# PKCS#7 padding for every possible pad length
+PADDING = [bytes([i])*i for i in range(17)]
 
 class CryptoMsgSocket:
     def __init__(self, sock, key):
         self.secret_key = key
+        # Key handle for the CBC helpers. Each message still builds a fresh
+        # CBC context, which expands the key again.
+        self.aes = aes_key(key)
+        # Session keys advance by encrypting them with the secret key
+        self.ratchet = aes_ecb_encryptor(self.aes)
+        # Every hash starts with the secret key, so absorb it once and copy
+        self.hash_base = hashlib.sha256(key)
         self.session_key = os.urandom(16)
         self.r_session_key = None
         self.on_msg = None
         self.on_err = None
         self.on_eof = None
         self.r, self.w = sock
+        # Decrypted messages land here, it only grows
+        self.rbuf = bytearray(256)
         self.closed = False
         self.t = None
 
@@ -27,7 +65,10 @@ class CryptoMsgSocket:
         if recv_first:
             await self._recv_sesskey()
             await self._send_sesskey()
-            ack = await self.r.read(2)
+            try:
+                ack = await self.r.readexactly(2)
+            except asyncio.IncompleteReadError as ex:
+                ack = ex.partial
             if ack != b'OK':
                 await self.close()
                 raise BrokenPipeError('No OK')
@@ -38,60 +79,69 @@ class CryptoMsgSocket:
             await self.w.drain()
         self.t = asyncio.create_task(self._recv_loop())
 
+    def _hash(self, *args):
+        h = self.hash_base.copy()
+        for arg in args:
+            h.update(arg)
+        return h.digest()[0:16]
+
     async def _recv_sesskey(self):
-        keys = await self.r.read(32)
-        if len(keys) != 32:
+        try:
+            keys = await self.r.readexactly(32)
+        except asyncio.IncompleteReadError:
             await self.close()
             raise BrokenPipeError('Unexpected stream length')
         self.r_session_key = keys[:16]
         auth = keys[16:]
-        if auth != hash(self.secret_key, self.r_session_key):
+        if not hmac.compare_digest(auth, self._hash(self.r_session_key)):
             await self.close()
             raise BrokenPipeError('Authentication failed')
 
     async def _send_sesskey(self):
-        self.w.write(self.session_key + hash(self.secret_key, self.session_key))
+        self.w.writelines((self.session_key, self._hash(self.session_key)))
         await self.w.drain()
 
     async def send(self, data):
+        # The whole frame is built in one buffer: auth, length, ciphertext
+        # and 15 bytes of slack for aes_cbc_encrypt_into
         padding_amt = 16 - len(data) % 16
-        data += bytes([padding_amt])*padding_amt
-        aes = AES.new(self.secret_key, AES.MODE_CBC, self.r_session_key)
-        data = aes.encrypt(data)
-
-        length = len(data)//16
-        length = bytes([length>>8, length&0xFF])
-        auth = hash(self.secret_key, self.r_session_key, data, length)
-        self.r_session_key = hash(self.secret_key, self.r_session_key)
-
-        self.w.write(auth + length + data)
+        size = len(data) + padding_amt
+        frame = memoryview(bytearray(18 + size + 15))
+        body = frame[18:18+size]
+        body[:len(data)] = data
+        body[len(data):] = PADDING[padding_amt]
+        aes_cbc_encrypt_into(self.aes, self.r_session_key, body, frame[18:])
+
+        struct.pack_into('>H', frame, 16, size//16)
+        frame[:16] = self._hash(self.r_session_key, body, frame[16:18])
+        self.r_session_key = self.ratchet(self.r_session_key)
+
+        self.w.write(frame[:18+size])
         await self.w.drain()
 
     async def _recv_loop(self):
         try:
             while True:
-                data = await self.r.read(18)
-                if len(data) != 18:
-                    raise BrokenPipeError('Unexpected stream length')
-
+                data = await self.r.readexactly(18)
                 auth = data[:16]
                 length = data[16:]
-                block_ct = (length[0] << 8) + length[1]
-                data_len = block_ct*16
-                ciphertext = await self.r.read(data_len)
-
-                if len(ciphertext) != data_len:
-                    raise BrokenPipeError('Unexpected stream length')
-                
-                if auth != hash(self.secret_key, self.session_key, ciphertext, length):
+                data_len = struct.unpack_from('>H', data, 16)[0]*16
+                ciphertext = await self.r.readexactly(data_len)
+
+                if not hmac.compare_digest(auth, self._hash(self.session_key, ciphertext, length)):
                     raise BrokenPipeError('Signature is invalid')
 
-                aes = AES.new(self.secret_key, AES.MODE_CBC, self.session_key)
-                ciphertext = aes.decrypt(ciphertext)
-                self.session_key = hash(self.secret_key, self.session_key)
-                self.on_msg(ciphertext[:-ciphertext[-1]])
+                if len(self.rbuf) < data_len + 15:
+                    self.rbuf = bytearray(max(data_len + 15, len(self.rbuf)*2))
+                plaintext = memoryview(self.rbuf)
+                aes_cbc_decrypt_into(self.aes, self.session_key, ciphertext, plaintext)
+                self.session_key = self.ratchet(self.session_key)
+                # The view is only valid until on_msg returns
+                self.on_msg(plaintext[:data_len - plaintext[data_len-1]])
         except GeneratorExit:
             self._close()
+        except asyncio.IncompleteReadError:
+            self._close_err(BrokenPipeError('Unexpected stream length'))
         except BrokenPipeError as ex:
             self._close_err(ex)
         finally:
@@ -2,6 +2,13 @@ import asyncio
 import json
 from acryptosocket import CryptoMsgSocket
 
+def json_dumps(obj):
+    return json.dumps(obj).encode('ascii')
+
+def json_loads(data):
+    # json can't parse the memoryview CryptoMsgSocket hands to on_msg
+    return json.loads(bytes(data))
+
 class URPCError(Exception):
     def __init__(self, error_name="URPCError", message="An unknown error occured."):
         self.error_name = error_name
@@ -9,14 +16,34 @@ class URPCError(Exception):
     def __str__(self):
         return str(self.error_name) + ": " + str(self.message)
 
+class _Method:
+    __slots__ = ('urpc', '__name__')
+
+    def __init__(self, urpc, name):
+        self.urpc = urpc
+        self.__name__ = name
+
+    async def __call__(self, *args, **kwargs):
+        success, result = await self.urpc._request([self.__name__, list(args), kwargs])
+        if success:
+            return result
+        error_name, error_msg = result
+        raise URPCError(error_name, error_msg)
+
 class URPC:
-    def __init__(self, address, secret_key, autopopulate=True):
+    def __init__(self, address, secret_key, autopopulate=True, max_batch=1):
         self.secret_key = secret_key
         self.sock = None
         self.should_populate = autopopulate
         self.address = address
-        self.callbacks = {}
-        self.cb_id = 0
+        # Pending callbacks indexed by request id, ids are reused once freed
+        self.callbacks = []
+        self.free_ids = []
+        # Requests made in the same loop iteration are sent as one message
+        # of up to max_batch requests. 1 disables batching.
+        self.max_batch = max_batch
+        self.send_queue = []
+        self.flush_task = None
 
     async def connect(self):
         s = await asyncio.open_connection(self.address, 80)        
@@ -33,37 +60,39 @@ class URPC:
     async def populate(self):
         self.auto_reconnect = False
         for method in await self.call("_dir"):
-            setattr(self, method, self._create_wrapper(method))
+            setattr(self, method, _Method(self, method))
 
-    def _create_wrapper(self, method):
-        async def wrapper(*args, **kwargs):
-            return await self.call(method, *args, **kwargs)
-        wrapper.__name__ = method
-        return wrapper
+    def _pop_callback(self, cb_id):
+        # The table is emptied when the connection drops
+        if cb_id >= len(self.callbacks):
+            return None
+        callback = self.callbacks[cb_id]
+        if callback is not None:
+            self.callbacks[cb_id] = None
+            self.free_ids.append(cb_id)
+        return callback
 
     def _on_msg(self, data):
         try:
-            ident, *data = json.loads(data)
-            callback = self.callbacks[ident]
-            del self.callbacks[ident]
-            callback(True, data)
+            ident, *data = json_loads(data)
+            callback = self._pop_callback(ident)
+            if callback is not None:
+                callback(True, data)
         except:
             pass
 
     def _on_eof(self):
         callbacks = self.callbacks
-        self.callbacks = {}
-        for callback in callbacks.values():
-            callback(False, BrokenPipeError('Connection lost'))
+        self.callbacks = []
+        self.free_ids = []
+        for callback in callbacks:
+            if callback is not None:
+                callback(False, BrokenPipeError('Connection lost'))
 
     async def _request(self, data):
         if self.sock is None:
             raise BrokenPipeError('Not connected')
 
-        cb_id = self.cb_id
-        self.cb_id += 1
-        data = [cb_id] + data
-        
         f = asyncio.Future()
         def callback(success, data):
             if f.cancelled():
@@ -72,11 +101,54 @@ class URPC:
                 f.set_result(data)
             else:
                 f.set_exception(data)
-        self.callbacks[cb_id] = callback
 
-        await self.sock.send(json.dumps(data).encode('ascii'))
+        if self.free_ids:
+            cb_id = self.free_ids.pop()
+            self.callbacks[cb_id] = callback
+        else:
+            cb_id = len(self.callbacks)
+            self.callbacks.append(callback)
+        data = [cb_id] + data
+        # Encoded here so a value JSON can't handle only fails its own call,
+        # not the rest of a batch
+        try:
+            msg = json_dumps(data)
+        except:
+            self._pop_callback(cb_id)
+            raise
+
+        if self.max_batch > 1:
+            self.send_queue.append((cb_id, msg))
+            if self.flush_task is None:
+                self.flush_task = asyncio.ensure_future(self._flush())
+        else:
+            # Once send() is entered the frame may already be written, so the
+            # slot stays until the reply or _on_eof frees it. Releasing it
+            # here would hand this call's reply to whoever reuses the id.
+            await self.sock.send(msg)
         return await f
 
+    async def _flush(self):
+        try:
+            while self.send_queue:
+                batch = self.send_queue[:self.max_batch]
+                del self.send_queue[:self.max_batch]
+                try:
+                    if self.sock is None:
+                        raise BrokenPipeError('Not connected')
+                    if len(batch) == 1:
+                        msg = batch[0][1]
+                    else:
+                        msg = b'[' + b','.join([record for _, record in batch]) + b']'
+                    await self.sock.send(msg)
+                except Exception as ex:
+                    for cb_id, _ in batch:
+                        callback = self._pop_callback(cb_id)
+                        if callback is not None:
+                            callback(False, ex)
+        finally:
+            self.flush_task = None
+
     async def disconnect(self):
         if self.sock:
             sock = self.sock
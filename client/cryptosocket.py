@@ -1,81 +1,149 @@
 import os
 import hashlib
-from Crypto.Cipher import AES
+import hmac
+import struct
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 
-def hash(*args):
-    h = hashlib.sha256()
-    for arg in args:
-        h.update(arg)
-    return h.digest()[0:16]
+    def aes_key(key):
+        return algorithms.AES(key)
+
+    def aes_ecb_encryptor(key):
+        return Cipher(key, modes.ECB()).encryptor().update
+
+    def aes_cbc_encrypt_into(key, iv, data, out):
+        # OpenSSL wants one block minus one byte of slack after the output
+        aes = Cipher(key, modes.CBC(iv)).encryptor()
+        aes.update_into(data, out)
+
+    def aes_cbc_decrypt_into(key, iv, data, out):
+        aes = Cipher(key, modes.CBC(iv)).decryptor()
+        aes.update_into(data, out)
+except ImportError:
+    from Crypto.Cipher import AES
+
+    def aes_key(key):
+        return key
+
+    def aes_ecb_encryptor(key):
+        return AES.new(key, AES.MODE_ECB).encrypt
+
+    def aes_cbc_encrypt_into(key, iv, data, out):
+        AES.new(key, AES.MODE_CBC, iv).encrypt(data, output=out[:len(data)])
+
+    def aes_cbc_decrypt_into(key, iv, data, out):
+        AES.new(key, AES.MODE_CBC, iv).decrypt(data, output=out[:len(data)])
+
+# PKCS#7 padding for every possible pad length
+PADDING = [bytes([i])*i for i in range(17)]
 
 class CryptoMsgSocket:
     def __init__(self, sock, key, recv_first=False):
         self.secret_key = key
+        # Key handle for the CBC helpers. Each message still builds a fresh
+        # CBC context, which expands the key again.
+        self.aes = aes_key(key)
+        # Session keys advance by encrypting them with the secret key
+        self.ratchet = aes_ecb_encryptor(self.aes)
+        # Every hash starts with the secret key, so absorb it once and copy
+        self.hash_base = hashlib.sha256(key)
         self.session_key = os.urandom(16)
         self.r_session_key = None
         self.sock = sock
+        # Frames are received and decrypted into these, they only grow
+        self.rx_header = bytearray(18)
+        self.rx_body = bytearray(256)
+        self.rbuf = bytearray(256)
 
         if recv_first:
             self._recv_sesskey()
             self._send_sesskey()
-            ack = self.sock.recv(2)
+            try:
+                ack = self._recv_exactly(2)
+            except BrokenPipeError:
+                ack = None
             if ack != b'OK':
                 self.close()
                 raise BrokenPipeError('No OK')
         else:
             self._send_sesskey()
             self._recv_sesskey()
-            self.sock.send(b'OK')
+            self.sock.sendall(b'OK')
+
+    def _hash(self, *args):
+        h = self.hash_base.copy()
+        for arg in args:
+            h.update(arg)
+        return h.digest()[0:16]
+
+    def _recv_into(self, view):
+        # recv() may return less than asked for when TCP splits a write
+        while view:
+            read = self.sock.recv_into(view)
+            if not read:
+                raise BrokenPipeError('Unexpected stream length')
+            view = view[read:]
+
+    def _recv_exactly(self, length):
+        data = bytearray(length)
+        self._recv_into(memoryview(data))
+        return data
 
     def _recv_sesskey(self):
-        keys = self.sock.recv(32)
-        if len(keys) != 32:
+        try:
+            keys = self._recv_exactly(32)
+        except BrokenPipeError:
             self.close()
-            raise BrokenPipeError('Unexpected stream length')
+            raise
         self.r_session_key = keys[:16]
         auth = keys[16:]
-        if auth != hash(self.secret_key, self.r_session_key):
+        if not hmac.compare_digest(auth, self._hash(self.r_session_key)):
             self.close()
             raise BrokenPipeError('Authentication failed')
 
     def _send_sesskey(self):
-        self.sock.send(self.session_key)
-        self.sock.send(hash(self.secret_key, self.session_key))
+        self.sock.sendall(self.session_key + self._hash(self.session_key))
 
     def send(self, data):
+        # The whole frame is built in one buffer: auth, length, ciphertext
+        # and 15 bytes of slack for aes_cbc_encrypt_into
         padding_amt = 16 - len(data) % 16
-        data += bytes([padding_amt])*padding_amt
-        aes = AES.new(self.secret_key, AES.MODE_CBC, self.r_session_key)
-        data = aes.encrypt(data)
+        size = len(data) + padding_amt
+        frame = memoryview(bytearray(18 + size + 15))
+        body = frame[18:18+size]
+        body[:len(data)] = data
+        body[len(data):] = PADDING[padding_amt]
+        aes_cbc_encrypt_into(self.aes, self.r_session_key, body, frame[18:])
 
-        length = len(data)//16
-        length = bytes([length>>8, length&0xFF])
-        auth = hash(self.secret_key, self.r_session_key, data, length)
-        self.r_session_key = hash(self.secret_key, self.r_session_key)
+        struct.pack_into('>H', frame, 16, size//16)
+        frame[:16] = self._hash(self.r_session_key, body, frame[16:18])
+        self.r_session_key = self.ratchet(self.r_session_key)
 
-        self.sock.send(auth + length + data)
+        self.sock.sendall(frame[:18+size])
     
     def recv(self):
-        data = self.sock.recv(18)
-        if len(data) != 18:
-            raise BrokenPipeError('Unexpected stream length')
-
-        auth = data[:16]
-        length = data[16:]
-        block_ct = (length[0] << 8) + length[1]
-        data_len = block_ct*16
-        ciphertext = self.sock.recv(data_len)
-
-        if len(ciphertext) != data_len:
-            raise BrokenPipeError('Unexpected stream length')
-        
-        if auth != hash(self.secret_key, self.session_key, ciphertext, length):
+        # The returned view points into rbuf and is only valid until the
+        # next recv() call
+        header = memoryview(self.rx_header)
+        self._recv_into(header)
+        auth = header[:16]
+        length = header[16:]
+        data_len = struct.unpack_from('>H', header, 16)[0]*16
+        if len(self.rx_body) < data_len:
+            self.rx_body = bytearray(max(data_len, len(self.rx_body)*2))
+        ciphertext = memoryview(self.rx_body)[:data_len]
+        self._recv_into(ciphertext)
+
+        if not hmac.compare_digest(auth, self._hash(self.session_key, ciphertext, length)):
             raise BrokenPipeError('Signature is invalid')
 
-        aes = AES.new(self.secret_key, AES.MODE_CBC, self.session_key)
-        ciphertext = aes.decrypt(ciphertext)
-        self.session_key = hash(self.secret_key, self.session_key)
-        return ciphertext[:-ciphertext[-1]]
+        if len(self.rbuf) < data_len + 15:
+            self.rbuf = bytearray(max(data_len + 15, len(self.rbuf)*2))
+        plaintext = memoryview(self.rbuf)
+        aes_cbc_decrypt_into(self.aes, self.session_key, ciphertext, plaintext)
+        self.session_key = self.ratchet(self.session_key)
+        # Strip the padding without copying the message
+        return plaintext[:data_len - plaintext[data_len-1]]
 
     def close(self):
         self.sock.close()
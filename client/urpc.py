@@ -2,6 +2,13 @@ import socket
 import json
 from cryptosocket import CryptoMsgSocket
 
+def json_dumps(obj):
+    return json.dumps(obj).encode('ascii')
+
+def json_loads(data):
+    # json can't parse the memoryview CryptoMsgSocket.recv returns
+    return json.loads(bytes(data))
+
 class URPCError(Exception):
     def __init__(self, error_name="URPCError", message="An unknown error occured."):
         self.error_name = error_name
@@ -52,8 +59,8 @@ class URPC:
                 raise BrokenPipeError('Not connected')
 
         data = [1] + data
-        self.sock.send(json.dumps(data).encode('ascii'))
-        return json.loads(self.sock.recv())[1:]
+        self.sock.send(json_dumps(data))
+        return json_loads(self.sock.recv())[1:]
 
     def disconnect(self):
         if self.sock:
@@ -1,11 +1,33 @@
 import socket
 from uasync import Promise
 
+class SocketWait(Promise):
+    # A Promise that only the socket's ready callback resolves. It holds a
+    # single callback and can't fail, so one instance is reused for every
+    # wait on a socket instead of building a Promise per read.
+    def __init__(self, asock):
+        self.asock = asock
+        self.iter_sent = False
+
+    def then(self, resolve):
+        asock = self.asock
+        if asock.current_task is not None:
+            raise RuntimeError("Cannot have multiple socket waits")
+        if asock.ready:
+            resolve()
+        else:
+            asock.current_task = resolve
+        return self
+
+    def catch(self, reject):
+        return self
+
 class AsyncSocket:
     def __init__(self, sock):
         self.sock = sock
         self.current_task = None
         self.ready = False
+        self.waiter = SocketWait(self)
         self.sock.setblocking(False)
 
         def ready_callback(sock):
@@ -17,38 +39,43 @@ class AsyncSocket:
         self.sock.setsockopt(socket.SOL_SOCKET, 20, ready_callback)
 
     def send(self, data):
-        self.sock.setblocking(True)
-        self.sock.send(data)
-        self.sock.setblocking(False)
+        self.sendall(data)
     
     def sendall(self, data):
-        self.sock.setblocking(True)
-        self.sock.sendall(data)
-        self.sock.setblocking(False)
+        # Most messages fit in lwIP's send buffer, so try a non-blocking
+        # write first and only switch to blocking mode for what's left
+        sent = self.sock.write(data)
+        if sent is None:
+            sent = 0
+        if sent < len(data):
+            self.sock.setblocking(True)
+            self.sock.sendall(memoryview(data)[sent:])
+            self.sock.setblocking(False)
 
     def close(self):
         self.sock.close()
 
     def wait(self):
-        def wrapper(resolve, _reject):
-            if self.ready:
-                resolve()
-            if self.current_task is not None:
-                raise RuntimeError("Cannot have multiple socket waits")
-            self.current_task = resolve
-        return Promise(wrapper)
+        waiter = self.waiter
+        waiter.iter_sent = False
+        return waiter
 
     async def _readinto(self, buffer, length):
-        if not self.ready:
-            await self.wait()
-        read = self.sock.readinto(buffer, length)
-        if read == length or read == 0:
-            return read
-        if read is None:
-            read = 0
-        self.ready = False
-        read += await self.readinto(buffer[read:], length-read)
-        return read
+        read = 0
+        while True:
+            if not self.ready:
+                await self.wait()
+            got = self.sock.readinto(buffer, length - read)
+            if got == 0:
+                return read
+            if got is None:
+                got = 0
+            read += got
+            if read == length:
+                return read
+            # Wait for more data before reading the rest
+            self.ready = False
+            buffer = buffer[got:]
 
     def readinto(self, buffer, length):
         if not isinstance(buffer, memoryview):
@@ -1,5 +1,6 @@
 # This file is executed on every boot (including wake-boot from deepsleep)
 import gc
+import time
 import ubinascii
 import config
 
@@ -13,7 +14,10 @@ def do_connect():
         sta_if.active(True)
         sta_if.connect(config.WIFI_SSID, config.WIFI_PASSWORD)
         while not sta_if.isconnected():
-            pass
+            if sta_if.status() in (network.STAT_WRONG_PASSWORD, network.STAT_NO_AP_FOUND, network.STAT_CONNECT_FAIL):
+                print('connection failed, status:', sta_if.status())
+                return
+            time.sleep_ms(100)
     print('network config:', sta_if.ifconfig())
     print('mac address:', ubinascii.hexlify(sta_if.config('mac'),':').decode())
 
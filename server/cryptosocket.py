@@ -1,17 +1,47 @@
 import hashlib
 import os
 import cryptolib
+import micropython
 from uasync import CoroPromise
 
-def hash(*args):
-    h = hashlib.sha256()
-    for arg in args:
-        h.update(arg)
-    return h.digest()[0:16]
+# PKCS#7 padding for every possible pad length
+PADDING = [bytes([i])*i for i in range(17)]
+
+# ECB contexts used to advance session keys, shared by every connection
+# using the same secret key so it is only expanded once
+_ratchets = {}
+
+def _get_ratchet(key):
+    ratchet = _ratchets.get(key)
+    if ratchet is None:
+        ratchet = cryptolib.aes(key, 1)
+        _ratchets[key] = ratchet
+    return ratchet
+
+@micropython.viper
+def ct_eq16(a: ptr8, b: ptr8) -> int:
+    # Compares 16 bytes in constant time, so a MAC check doesn't leak how
+    # many leading bytes matched
+    r = 0
+    for i in range(16):
+        r |= int(a[i]) ^ int(b[i])
+    if r:
+        return 0
+    return 1
 
 class CryptoMsgSocket:
     def __init__(self, sock, key):
         self.secret_key = key
+        # Session keys advance by encrypting them with the secret key (ECB)
+        self.ratchet = _get_ratchet(key)
+        # Every hash starts with secret_key + a session key, this buffer
+        # holds both so they go to sha256 in one call
+        self.hash_prefix = bytearray(key + bytes(16))
+        # Outgoing frames are built here, it grows to the largest frame sent
+        self.tx_buf = bytearray()
+        # Incoming headers and ciphertext are read here, rx_buf only grows
+        self.rx_header = bytearray(18)
+        self.rx_buf = bytearray()
         self.session_key = os.urandom(16)
         self.r_session_key = None
         self.on_msg = None
@@ -26,6 +56,14 @@ class CryptoMsgSocket:
             self.on_eof = None
         self.sock.close()
 
+    def _hash(self, session_key, *args):
+        prefix = self.hash_prefix
+        prefix[len(self.secret_key):] = session_key
+        h = hashlib.sha256(prefix)
+        for arg in args:
+            h.update(arg)
+        return h.digest()[0:16]
+
     def _close_err(self, reason):
         if self.on_err is not None:
             self.on_err(reason)
@@ -38,60 +76,76 @@ class CryptoMsgSocket:
             raise EOFError('Unexpected stream length')
         self.r_session_key = keys[:16]
         auth = keys[16:]
-        if auth != hash(self.secret_key, self.r_session_key):
+        if not ct_eq16(auth, self._hash(self.r_session_key)):
             self.close()
             raise EOFError('Authentication failed')
 
     async def _send_sesskey(self):
-        self.sock.send(self.session_key)
-        self.sock.send(hash(self.secret_key, self.session_key))
+        self.sock.sendall(self.session_key + self._hash(self.session_key))
 
     async def _recv_loop(self):
+        header = memoryview(self.rx_header)
         try:
             while True:
-                header = await self.sock.recv(18)
-                if len(header) != 18:
-                    if len(header) != 0:
+                read = await self.sock.readinto(header, 18)
+                if read != 18:
+                    if read != 0:
                         self._close_err("header short read")
                     return
 
                 length = header[16:]
                 get_length = ((length[0] << 8) + length[1])*16
-                ciphertext = bytearray(get_length)
-                
+                if len(self.rx_buf) < get_length:
+                    self.rx_buf = bytearray(get_length)
+                ciphertext = memoryview(self.rx_buf)[:get_length]
+
                 if not (await self.sock.readinto(ciphertext, get_length)) == get_length:
                     self._close_err("message short read")
                     return
                 
-                if header[:16] != hash(self.secret_key, self.session_key, ciphertext, length):
+                if not ct_eq16(header, self._hash(self.session_key, ciphertext, length)):
                     self._close_err("invalid authentication header")
                     return
 
                 aes = cryptolib.aes(self.secret_key, 2, self.session_key)
                 aes.decrypt(ciphertext, ciphertext)
+                padding_amt = ciphertext[-1] if get_length else 0
+                if padding_amt == 0 or padding_amt > 16:
+                    self._close_err("invalid padding")
+                    return
                 try:
-                    self.on_msg(memoryview(ciphertext)[:-ciphertext[-1]])
+                    # on_msg borrows the buffer, it must be done with it
+                    # before returning
+                    self.on_msg(ciphertext[:-padding_amt])
                 except Exception as ex:
                     import sys
                     sys.print_exception(ex)
-                self.session_key = hash(self.secret_key, self.session_key)
+                self.session_key = self.ratchet.encrypt(self.session_key)
         finally:
             self.close()
 
     def send(self, data):
+        # auth, length and ciphertext are built in one buffer so the whole
+        # frame goes out in one write
         padding_amt = 16 - len(data) % 16
-        data.extend(bytes([padding_amt])*padding_amt)
+        size = len(data) + padding_amt
+        if len(self.tx_buf) < 18 + size:
+            self.tx_buf = bytearray(18 + size)
+        frame = memoryview(self.tx_buf)[:18 + size]
+        body = frame[18:]
+        body[:len(data)] = data
+        body[len(data):] = PADDING[padding_amt]
 
         aes = cryptolib.aes(self.secret_key, 2, self.r_session_key)
-        aes.encrypt(data, data)
+        aes.encrypt(body, body)
 
-        length = len(data)//16
-        length = bytes([length>>8, length&0xFF])
-        auth = hash(self.secret_key, self.r_session_key, data, length)
-        self.r_session_key = hash(self.secret_key, self.r_session_key)
+        length = size//16
+        frame[16] = length >> 8
+        frame[17] = length & 0xFF
+        frame[:16] = self._hash(self.r_session_key, body, frame[16:18])
+        self.r_session_key = self.ratchet.encrypt(self.r_session_key)
 
-        self.sock.send(auth + length)
-        self.sock.send(data)
+        self.sock.sendall(frame)
 
     async def start(self, recv_first=False):
         if self.on_msg is None:
@@ -106,5 +160,5 @@ class CryptoMsgSocket:
         else:
             await self._send_sesskey()
             await self._recv_sesskey()
-            self.sock.send(b'OK')
+            self.sock.sendall(b'OK')
         CoroPromise(self._recv_loop())
\ No newline at end of file
@@ -1,6 +1,30 @@
 import machine
 import micropython
 
+# Callbacks run directly until this many are nested, deeper ones are
+# scheduled so the stack can unwind first
+MAX_CALL_DEPTH = 6
+_call_depth = 0
+
+def _call(callback, arg):
+    global _call_depth
+    if _call_depth >= MAX_CALL_DEPTH:
+        try:
+            micropython.schedule(callback, arg)
+            return
+        except RuntimeError:
+            pass
+    # A failing callback is reported like a scheduled one would be, it
+    # must not reach whoever resolved the promise or skip the others
+    _call_depth += 1
+    try:
+        callback(arg)
+    except Exception as ex:
+        import sys
+        sys.print_exception(ex)
+    finally:
+        _call_depth -= 1
+
 class Promise():
     def __init__(self, wrapper):
         self._resolve_callbacks = []
@@ -53,18 +77,12 @@ class Promise():
                 reject_callbacks = self._reject_callbacks
                 self._reject_callbacks = []
                 for reject in reject_callbacks:
-                    try:
-                        micropython.schedule(reject, self.exception)
-                    except RuntimeError:
-                        reject(self.exception)
+                    _call(reject, self.exception)
             else:
                 resolve_callbacks = self._resolve_callbacks
                 self._resolve_callbacks = []
                 for resolve in resolve_callbacks:
-                    try:
-                        micropython.schedule(resolve, self.result)
-                    except RuntimeError:
-                        resolve(self.result)
+                    _call(resolve, self.result)
 
 class CoroPromise(Promise):
     def __init__(self, coro):
@@ -99,8 +117,16 @@ class CoroPromise(Promise):
 def is_coroutine(obj):
     return hasattr(obj, 'send')
 
+# Handlers mostly return the same few types, so the answer is cached per type
+_awaitable_types = {}
+
 def is_awaitable(obj):
-    return hasattr(obj, 'send') or isinstance(obj, Promise)
+    t = type(obj)
+    result = _awaitable_types.get(t)
+    if result is None:
+        result = hasattr(obj, 'send') or isinstance(obj, Promise)
+        _awaitable_types[t] = result
+    return result
 
 def delay(ms):
     timer = machine.Timer(-1) # software timer
@@ -29,11 +29,18 @@ class URPC:
                 conn = CryptoMsgSocket(conn, self.secret_key)
 
                 async def on_msg_async(msg):
-                    identifier, handler_name, args, kwargs = json.loads(msg)
+                    identifier, handler_name, args, kwargs = msg
 
                     success = True
                     try:
-                        data = self.rpc_handlers[handler_name](*args, **kwargs)
+                        func = self.rpc_handlers[handler_name]
+                        # Skip building argument tuples and dicts when there's nothing to pass
+                        if kwargs:
+                            data = func(*args, **kwargs)
+                        elif args:
+                            data = func(*args)
+                        else:
+                            data = func()
                         if is_awaitable(data):
                             data = await data
                     except Exception as ex:
@@ -43,7 +50,13 @@ class URPC:
                     conn.send(bytearray(json.dumps([identifier, success, data])))
                 
                 def on_msg(msg):
-                    CoroPromise(on_msg_async(msg))
+                    msg = json.loads(msg)
+                    # A batch is a list of requests instead of a single one
+                    if isinstance(msg[0], list):
+                        for request in msg:
+                            CoroPromise(on_msg_async(request))
+                    else:
+                        CoroPromise(on_msg_async(msg))
 
                 conn.on_msg = on_msg
                 await conn.start()